@@ -1,14 +1,23 @@
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient
+import httpx
 import json
+import orjson
 import streamlit as st
 import os
 from dotenv import load_dotenv
 import time
 import uuid
 from datetime import datetime
-import pandas as pd
+import csv
 import random
+from collections import deque
+import hashlib
+import queue
 import smtplib
+import threading
+import io
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
@@ -16,23 +25,119 @@ from email.mime.application import MIMEApplication
 # Load environment variables
 load_dotenv()
 
+# Streamlit re-executes this script on every rerun, so anything that must outlive a single
+# run (API client, worker pools, the SMTP connection) is created via st.cache_resource.
+
+@st.cache_resource(show_spinner=False)
+def get_llm_client(api_key):
+    """Create the OpenAI client once, with a keep-alive HTTP/2 connection pool."""
+    http_client = DefaultHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=32)
+    )
+    return OpenAI(api_key=api_key, http_client=http_client)
+
+@st.cache_resource(show_spinner=False)
+def get_worker_pool(name, max_workers):
+    """Get a named worker pool that survives script reruns."""
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
 # Setup OpenAI API client
 api_key = os.getenv("OPENAI_API_KEY")
 client = None
 if api_key:
-    client = OpenAI(api_key=api_key)
+    client = get_llm_client(api_key)
+
+@st.cache_resource(show_spinner=False)
+def create_data_dir():
+    """Create the directory for saved conversations, logs and the preferences summary once."""
+    os.makedirs("conversation_data", exist_ok=True)
+
+create_data_dir()
 
 # Conversation context window size
 CONTEXT_WINDOW = 5
 
-def generate_conditional_response_prompt(user_profile, conversation_context):
-    """Generate a conditional response framework prompt."""
-    base_persona = """You are BestieAI, a warm, supportive friend who genuinely cares about the user and communicates in a natural, conversational manner."""
-    user_context = f"""You're speaking with {user_profile['preferred_name']}, who:
-- Has interests in: {', '.join(user_profile['top_interests'])}
-- Recently: {user_profile['recent_events']}
-- Has a communication style that is: {user_profile['communication_style']}"""
-    conditional_frameworks = """Use these specialized response frameworks based on the detected user need:
+# Messages older than the context window are folded into a rolling summary in batches of this size
+SUMMARY_INTERVAL = 10
+
+# Bounds for the per-user completion token cap learned from accepted response lengths
+MIN_RESPONSE_TOKENS = 120
+MAX_RESPONSE_TOKENS = 400
+
+# Accepted responses needed before the learned token cap replaces MAX_RESPONSE_TOKENS
+MIN_REPLY_SAMPLES = 10
+
+# Fraction of turns that generate both techniques for the A/B comparison; other turns
+# generate a single technique
+AB_SAMPLE_RATE = float(os.getenv("AB_SAMPLE_RATE", "0.2"))
+
+# Once one technique leads by this many votes it is always used, with A/B only on probe turns
+STABLE_PREFERENCE_MARGIN = 5
+PROBE_RATE = 0.1
+
+# Messages kept in session state; the full conversation is logged to disk
+MAX_HISTORY = 200
+
+# Most recent messages rendered in the chat; older ones are shown on demand
+DISPLAY_WINDOW = 50
+
+# Response IDs pre-generated off the chat path
+UUID_POOL_SIZE = 64
+
+@st.cache_resource(show_spinner=False)
+def get_uuid_pool():
+    """Get a queue of response IDs kept topped up by a background thread."""
+    uuid_pool = queue.Queue(maxsize=UUID_POOL_SIZE)
+
+    def fill():
+        while True:
+            uuid_pool.put(uuid.uuid4().hex)
+
+    threading.Thread(target=fill, name="uuid-pool", daemon=True).start()
+    return uuid_pool
+
+uuid_pool = get_uuid_pool()
+
+# Stylesheet for the emailed conversation report
+EMAIL_CSS = """
+                <style>
+                    body { font-family: Arial, sans-serif; line-height: 1.6; }
+                    .summary { background-color: #f0f0f0; padding: 15px; margin-bottom: 20px; border-radius: 5px; }
+                    .user-info { background-color: #e8f5e9; padding: 15px; margin-bottom: 20px; border-radius: 5px; }
+                    .conversation { margin-top: 20px; }
+                    .user-message { background-color: #e1f5fe; padding: 10px; margin: 5px 0; border-radius: 5px; }
+                    .assistant-message { background-color: #f5f5f5; padding: 10px; margin: 5px 0; border-radius: 5px; }
+                </style>
+            """
+
+# CSS class and speaker label for each role in the emailed transcript
+TRANSCRIPT_STYLES = {
+    "user": ("user-message", "User"),
+    "assistant": ("assistant-message", "BestieAI")
+}
+
+# Worker pool for sending email reports off the script thread
+email_pool = get_worker_pool("email", 2)
+
+# Email attachments are zipped together when there is more than one or they exceed this size
+ZIP_ATTACHMENT_THRESHOLD = 100 * 1024
+ZIP_ATTACHMENT_NAME = "bestieai_report.zip"
+
+# Authenticated SMTP connection reused across email sends
+@st.cache_resource(show_spinner=False)
+def get_smtp_state():
+    """Get the holder for the shared SMTP connection and the lock guarding it."""
+    return {"connection": None, "lock": threading.Lock()}
+
+smtp_state = get_smtp_state()
+
+# Static prompt prefixes. The user profile is appended to form the system message and the
+# per-turn conversation context goes in the user message, so the system message stays
+# byte-identical across turns for provider prompt caching.
+CONDITIONAL_PREFIX = """You are BestieAI, a warm, supportive friend who genuinely cares about the user and communicates in a natural, conversational manner.
+
+Use these specialized response frameworks based on the detected user need:
 
 IF user is sharing personal experiences or emotions:
   - Acknowledge their feelings first
@@ -60,32 +165,15 @@ IF user seems confused or frustrated:
   - Break down complex information into steps
   - Confirm understanding before proceeding
   - Offer alternative explanations or approaches
-  - Maintain encouraging, patient tone"""
-    directive = f"""First, determine which scenario best matches the user's message, then respond according to that framework while maintaining your friendly, personalized approach. Always sound like a supportive friend, not an AI assistant. Use appropriate cultural references when relevant.
+  - Maintain encouraging, patient tone
 
-Current conversation context:
-{conversation_context}
+First, determine which scenario best matches the user's message, then respond according to that framework while maintaining your friendly, personalized approach. Always sound like a supportive friend, not an AI assistant. Use appropriate cultural references when relevant.
 
 Build on the ongoing conversation by referencing relevant points from the current chat. Avoid bringing up past habits or profile details unless directly relevant to the current topic. If the user's input is unclear, ask for clarification. Occasionally ask follow-up questions or suggest related topics to keep the conversation engaging."""
-    prompt = f"{base_persona}\n\n{user_context}\n\n{conditional_frameworks}\n\n{directive}"
-    return prompt
-
-def generate_dynamic_context_prompt(user_profile, conversation_context):
-    """Generate a dynamic context injection prompt."""
-    prompt = f"""You are BestieAI, a conversational AI that functions as a supportive, understanding best friend.
-
-Your conversation with {user_profile['name']} has the following relevant context:
 
-USER PROFILE:
-- Preferred name: {user_profile['preferred_name']}
-- Communication style: {user_profile['communication_style']}
-- Primary interests: {', '.join(user_profile['top_interests'])}
-- Recent life events: {user_profile['recent_events']}
-
-CURRENT CONVERSATION CONTEXT:
-{conversation_context}
+DYNAMIC_CONTEXT_PREFIX = """You are BestieAI, a conversational AI that functions as a supportive, understanding best friend.
 
-Use this context to personalize your response while maintaining your friendly, supportive persona. Reference relevant points from the current conversation naturally without explicitly mentioning this instruction. Avoid bringing up past habits or profile details unless directly relevant to the current topic.
+Use the profile below and the conversation context you are given to personalize your response while maintaining your friendly, supportive persona. Reference relevant points from the current conversation naturally without explicitly mentioning this instruction. Avoid bringing up past habits or profile details unless directly relevant to the current topic.
 
 Remember that you are simulating a best friend, not an assistant:
 - Use casual, warm language with appropriate expressions
@@ -95,29 +183,186 @@ Remember that you are simulating a best friend, not an assistant:
 - Include culturally relevant references when appropriate
 
 If the user's input is unclear, ask for clarification. Occasionally ask follow-up questions or suggest related topics to keep the conversation engaging."""
-    return prompt
 
-def get_completion(system_prompt, user_message, model="gpt-4o-mini", max_tokens=400):
-    """Get a completion from the OpenAI API."""
+@st.cache_resource(show_spinner=False, max_entries=128)
+def _conditional_profile_block(profile_version, _user_profile):
+    """Build the static prefix plus user profile section of the conditional prompt.
+
+    Cached on the profile version token only; the leading underscore keeps the profile
+    itself out of Streamlit's cache key.
+    """
+    user_context = f"""You're speaking with {_user_profile['preferred_name']}, who:
+- Has interests in: {', '.join(_user_profile['top_interests'])}
+- Recently: {_user_profile['recent_events']}
+- Has a communication style that is: {_user_profile['communication_style']}"""
+    return f"{CONDITIONAL_PREFIX}\n\n{user_context}"
+
+@st.cache_resource(show_spinner=False, max_entries=128)
+def _dynamic_context_profile_block(profile_version, _user_profile):
+    """Build the static prefix plus user profile section of the dynamic context prompt.
+
+    Cached on the profile version token only, like _conditional_profile_block.
+    """
+    user_context = f"""Your conversation with {_user_profile['name']} has the following relevant context:
+
+USER PROFILE:
+- Preferred name: {_user_profile['preferred_name']}
+- Communication style: {_user_profile['communication_style']}
+- Primary interests: {', '.join(_user_profile['top_interests'])}
+- Recent life events: {_user_profile['recent_events']}"""
+    return f"{DYNAMIC_CONTEXT_PREFIX}\n\n{user_context}"
+
+def generate_conditional_response_prompt(user_profile, profile_version, conversation_context, user_input):
+    """Generate the messages for a conditional response framework prompt."""
+    profile_block = _conditional_profile_block(profile_version, user_profile)
+    return [
+        {"role": "system", "content": profile_block},
+        {"role": "user", "content": f"Current conversation context:\n{conversation_context}\n\nUser's latest message (reply to this):\n{user_input}"}
+    ]
+
+def generate_dynamic_context_prompt(user_profile, profile_version, conversation_context, user_input):
+    """Generate the messages for a dynamic context injection prompt."""
+    profile_block = _dynamic_context_profile_block(profile_version, user_profile)
+    return [
+        {"role": "system", "content": profile_block},
+        {"role": "user", "content": f"CURRENT CONVERSATION CONTEXT:\n{conversation_context}\n\nUSER'S LATEST MESSAGE (REPLY TO THIS):\n{user_input}"}
+    ]
+
+PROMPT_GENERATORS = {
+    "conditional": generate_conditional_response_prompt,
+    "dynamic_context": generate_dynamic_context_prompt
+}
+
+# Possible (option A, option B) technique assignments for an A/B turn
+OPTION_ORDERS = (("conditional", "dynamic_context"), ("dynamic_context", "conditional"))
+
+def stream_completion(messages, model="gpt-4o-mini", max_tokens=MAX_RESPONSE_TOKENS):
+    """Stream a completion from the OpenAI API.
+
+    Yields (content delta, finish reason) pairs as they arrive; the finish reason is None
+    until the final chunk.
+    """
+    if not client:
+        yield "Error: OpenAI API key not found. Please set OPENAI_API_KEY in your environment variables.", None
+        return
+    try:
+        with client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0.7,
+            max_tokens=max_tokens,
+            stream=True
+        ) as stream:
+            for chunk in stream:
+                if chunk.choices:
+                    yield chunk.choices[0].delta.content or "", chunk.choices[0].finish_reason
+    except Exception as e:
+        yield f"Error: {str(e)}", None
+
+def summarize_conversation(previous_summary, context_lines, model="gpt-4o-mini"):
+    """Fold older conversation lines into the rolling summary. Returns None on failure."""
     if not client:
-        return "Error: OpenAI API key not found. Please set OPENAI_API_KEY in your environment variables."
+        return None
+    new_messages = "\n".join(context_lines)
     try:
         response = client.chat.completions.create(
             model=model,
             messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
+                {"role": "system", "content": "Summarize the conversation between a user and BestieAI in a few sentences. Keep names, facts, feelings and open questions. Merge in the previous summary if one is given."},
+                {"role": "user", "content": f"Previous summary:\n{previous_summary or 'None'}\n\nNew messages:\n{new_messages}"}
             ],
-            temperature=0.7,
-            max_tokens=max_tokens
+            temperature=0.3,
+            max_tokens=200
         )
-        
         return response.choices[0].message.content
-    except Exception as e:
-        return f"Error: {str(e)}"
+    except Exception:
+        return None
+
+def run_in_background(fn, *args):
+    """Run fn on its own worker thread and return its future."""
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(fn, *args)
+    executor.shutdown(wait=False)
+    return future
+
+def stream_completions(prompts, placeholders, model="gpt-4o-mini", max_tokens=MAX_RESPONSE_TOKENS):
+    """Stream completions for several prompts concurrently into their placeholders.
+
+    Worker threads only push deltas onto a queue; all Streamlit calls stay on the script thread.
+    Each call gets its own workers, so sessions never queue behind each other, and the streams
+    are abandoned if the run is interrupted. Returns the full texts and their finish reasons,
+    each in the same order as the prompts.
+    """
+    deltas = queue.Queue()
+    cancelled = threading.Event()
+    finish_reasons = [None] * len(prompts)
+
+    def pump(index, messages):
+        stream = stream_completion(messages, model, max_tokens)
+        try:
+            for delta, finish_reason in stream:
+                if cancelled.is_set():
+                    break
+                if finish_reason:
+                    finish_reasons[index] = finish_reason
+                deltas.put((index, delta))
+        finally:
+            stream.close()
+            deltas.put((index, None))
+
+    executor = ThreadPoolExecutor(max_workers=len(prompts), thread_name_prefix="completion")
+    try:
+        for index, messages in enumerate(prompts):
+            executor.submit(pump, index, messages)
+        texts = [""] * len(prompts)
+        remaining = len(prompts)
+        while remaining:
+            index, delta = deltas.get()
+            if delta is None:
+                remaining -= 1
+                continue
+            texts[index] += delta
+            placeholders[index].markdown(texts[index])
+        return texts, finish_reasons
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False)
+
+def get_smtp_connection(smtp_server, smtp_port, sender_email, sender_password):
+    """Return the shared authenticated SMTP connection, reconnecting if it has dropped.
+
+    Callers must hold smtp_state["lock"].
+    """
+    smtp_connection = smtp_state["connection"]
+    if smtp_connection is not None:
+        try:
+            if smtp_connection.noop()[0] == 250:
+                return smtp_connection
+        except smtplib.SMTPException:
+            pass
+        try:
+            smtp_connection.close()
+        except Exception:
+            pass
+    smtp_state["connection"] = None
+    server = smtplib.SMTP(smtp_server, smtp_port)
+    try:
+        server.ehlo()
+        server.starttls()
+        server.login(sender_email, sender_password)
+    except Exception:
+        server.close()
+        raise
+    smtp_state["connection"] = server
+    return server
 
 def send_email(recipient_email, subject, body, attachments=None):
-    """Send an email with optional attachments using Gmail."""
+    """Send an email with optional attachments using Gmail.
+
+    Attachments are file paths or (filename, bytes) tuples for data already in memory.
+    Runs on a background thread, so errors are returned rather than shown:
+    returns a (sent, error_message) tuple.
+    """
     # Get email credentials from environment variables
     sender_email = os.getenv("EMAIL_USERNAME")
     sender_password = os.getenv("EMAIL_PASSWORD")
@@ -125,8 +370,7 @@ def send_email(recipient_email, subject, body, attachments=None):
     smtp_port = int(os.getenv("SMTP_PORT", "587"))
     
     if not sender_email or not sender_password:
-        st.error("Email credentials not found. Please set EMAIL_USERNAME and EMAIL_PASSWORD in your .env file.")
-        return False
+        return False, "Email credentials not found. Please set EMAIL_USERNAME and EMAIL_PASSWORD in your .env file."
     
     # Create message
     msg = MIMEMultipart()
@@ -137,40 +381,49 @@ def send_email(recipient_email, subject, body, attachments=None):
     # Attach body
     msg.attach(MIMEText(body, 'html'))
     
-    # Attach files
+    # Attach files, bundled into a single ZIP when there are several or they are large
     if attachments:
-        for attachment_path in attachments:
-            if os.path.exists(attachment_path):
-                with open(attachment_path, 'rb') as file:
-                    attachment = MIMEApplication(file.read(), Name=os.path.basename(attachment_path))
-                attachment['Content-Disposition'] = f'attachment; filename="{os.path.basename(attachment_path)}"'
-                msg.attach(attachment)
+        attachment_files = []
+        for attachment in attachments:
+            if isinstance(attachment, tuple):
+                attachment_files.append(attachment)
+            else:
+                try:
+                    with open(attachment, 'rb') as file:
+                        attachment_files.append((os.path.basename(attachment), file.read()))
+                except FileNotFoundError:
+                    pass
+        total_size = sum(len(data) for _, data in attachment_files)
+        if len(attachment_files) > 1 or total_size > ZIP_ATTACHMENT_THRESHOLD:
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+                for name, data in attachment_files:
+                    archive.writestr(name, data)
+            attachment_files = [(ZIP_ATTACHMENT_NAME, buffer.getvalue())]
+        for name, data in attachment_files:
+            attachment = MIMEApplication(data, Name=name)
+            attachment['Content-Disposition'] = f'attachment; filename="{name}"'
+            msg.attach(attachment)
     
-    # Send email
-    try:
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        server.send_message(msg)
-        server.quit()
-        return True
-    except Exception as e:
-        st.error(f"Failed to send email: {str(e)}")
-        return False
+    # Send email over the shared connection
+    with smtp_state["lock"]:
+        try:
+            server = get_smtp_connection(smtp_server, smtp_port, sender_email, sender_password)
+            server.send_message(msg)
+            return True, None
+        except Exception as e:
+            if smtp_state["connection"] is not None:
+                try:
+                    smtp_state["connection"].close()
+                except Exception:
+                    pass
+            smtp_state["connection"] = None
+            return False, f"Failed to send email: {str(e)}."
 
 def save_conversation(conversation_id, user_id, conversation_history, preferred_technique, feedback, send_email_report=False):
     """Save conversation history, user preference, and feedback to file."""
-    preferred_techniques_count = {}
-    total_responses = 0
-    for message in conversation_history:
-        if message.get("role") == "assistant" and "response_id" in message:
-            response_id = message.get("response_id")
-            if response_id in st.session_state.preferred_technique:
-                technique = st.session_state.preferred_technique[response_id]
-                if technique not in preferred_techniques_count:
-                    preferred_techniques_count[technique] = 0
-                preferred_techniques_count[technique] += 1
-                total_responses += 1
+    preferred_techniques_count = st.session_state.technique_counts
+    total_responses = sum(preferred_techniques_count.values())
     technique_percentages = {tech: (count / total_responses * 100) if total_responses > 0 else 0 for tech, count in preferred_techniques_count.items()}
     data = {
         "conversation_id": conversation_id,
@@ -184,16 +437,16 @@ def save_conversation(conversation_id, user_id, conversation_history, preferred_
         "detailed_preferences": {k: v for k, v in st.session_state.preferred_technique.items()},
         "feedback": feedback
     }
-    os.makedirs("conversation_data", exist_ok=True)
     filename = f"conversation_data/conversation_{conversation_id}.json"
     try:
-        with open(filename, "w") as f:
-            json.dump(data, f, indent=2)
+        json_bytes = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        with open(filename, "wb") as f:
+            f.write(json_bytes)
     except Exception as e:
         st.error(f"Failed to save JSON file: {str(e)}")
         return None
     csv_file = "conversation_data/preferences_summary.csv"
-    new_row = pd.DataFrame([{
+    new_row = {
         "conversation_id": conversation_id,
         "user_id": user_id,
         "timestamp": datetime.now().isoformat(),
@@ -205,14 +458,14 @@ def save_conversation(conversation_id, user_id, conversation_history, preferred_
         "user_name": st.session_state.user_profile.get("name", ""),
         "communication_style": st.session_state.user_profile.get("communication_style", ""),
         "feedback": feedback
-    }])
+    }
     try:
-        if os.path.exists(csv_file):
-            df = pd.read_csv(csv_file)
-            df = pd.concat([df, new_row], ignore_index=True)
-        else:
-            df = new_row
-        df.to_csv(csv_file, index=False)
+        with open(csv_file, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=list(new_row), lineterminator=os.linesep)
+            # An empty file was just created, so it needs the header row
+            if f.tell() == 0:
+                writer.writeheader()
+            writer.writerow(new_row)
     except Exception as e:
         st.error(f"Failed to save CSV file: {str(e)}")
         return None
@@ -222,28 +475,24 @@ def save_conversation(conversation_id, user_id, conversation_history, preferred_
         # Send email with conversation data to admin
         admin_email = os.getenv("ADMIN_EMAIL")
         if admin_email:
+            profile = st.session_state.user_profile
+            name = profile.get('name', 'Not provided')
+            preferred_name = profile.get('preferred_name', 'Not provided')
+            communication_style = profile.get('communication_style', 'Not provided')
+            interests = ', '.join(profile.get('top_interests', ['Not provided']))
             # Create HTML email body with conversation transcript and user info
-            email_body = f"""
+            email_header = f"""
             <html>
-            <head>
-                <style>
-                    body {{ font-family: Arial, sans-serif; line-height: 1.6; }}
-                    .summary {{ background-color: #f0f0f0; padding: 15px; margin-bottom: 20px; border-radius: 5px; }}
-                    .user-info {{ background-color: #e8f5e9; padding: 15px; margin-bottom: 20px; border-radius: 5px; }}
-                    .conversation {{ margin-top: 20px; }}
-                    .user-message {{ background-color: #e1f5fe; padding: 10px; margin: 5px 0; border-radius: 5px; }}
-                    .assistant-message {{ background-color: #f5f5f5; padding: 10px; margin: 5px 0; border-radius: 5px; }}
-                </style>
-            </head>
+            <head>{EMAIL_CSS}</head>
             <body>
                 <h2>BestieAI Conversation Summary</h2>
                 
                 <div class="user-info">
                     <h3>User Information</h3>
-                    <p><strong>Name:</strong> {st.session_state.user_profile.get('name', 'Not provided')}</p>
-                    <p><strong>Preferred Name:</strong> {st.session_state.user_profile.get('preferred_name', 'Not provided')}</p>
-                    <p><strong>Communication Style:</strong> {st.session_state.user_profile.get('communication_style', 'Not provided')}</p>
-                    <p><strong>Interests:</strong> {', '.join(st.session_state.user_profile.get('top_interests', ['Not provided']))}</p>
+                    <p><strong>Name:</strong> {name}</p>
+                    <p><strong>Preferred Name:</strong> {preferred_name}</p>
+                    <p><strong>Communication Style:</strong> {communication_style}</p>
+                    <p><strong>Interests:</strong> {interests}</p>
                     <p><strong>User ID:</strong> {user_id}</p>
                     <p><strong>Conversation ID:</strong> {conversation_id}</p>
                     <p><strong>Timestamp:</strong> {datetime.now().isoformat()}</p>
@@ -264,39 +513,55 @@ def save_conversation(conversation_id, user_id, conversation_history, preferred_
             """
             
             # Add conversation transcript
+            parts = [email_header]
             for message in conversation_history:
-                role = message.get("role", "")
-                content = message.get("content", "")
-                
-                if role == "user":
-                    email_body += f'<div class="user-message"><strong>User:</strong> {content}</div>\n'
-                elif role == "assistant":
-                    email_body += f'<div class="assistant-message"><strong>BestieAI:</strong> {content}</div>\n'
-            
-            email_body += """
+                message_style = TRANSCRIPT_STYLES.get(message.get("role", ""))
+                if message_style:
+                    css_class, label = message_style
+                    parts.append(f'<div class="{css_class}"><strong>{label}:</strong> {message.get("content", "")}</div>\n')
+            parts.append("""
                 </div>
             </body>
             </html>
-            """
+            """)
+            email_body = "".join(parts)
             
             # Prepare attachments
-            attachments = []
-            if os.path.exists(csv_file):
-                attachments.append(csv_file)
-            if os.path.exists(filename):
-                attachments.append(filename)
+            attachments = [csv_file, (os.path.basename(filename), json_bytes)]
             
-            # Send email
-            email_sent = send_email(
+            # Send email in the background so saving doesn't block on SMTP
+            email_future = email_pool.submit(
+                send_email,
                 admin_email,
-                f"BestieAI Conversation Summary - User: {st.session_state.user_profile.get('name', 'Unknown')} - {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+                f"BestieAI Conversation Summary - User: {profile.get('name', 'Unknown')} - {datetime.now().strftime('%Y-%m-%d %H:%M')}",
                 email_body,
                 attachments
             )
-            return filename, email_sent
+            return filename, email_future
     
     return filename
 
+# Seconds between idle checks
+IDLE_CHECK_INTERVAL = 30
+
+# Seconds between checks on a background email send
+EMAIL_CHECK_INTERVAL = 2
+
+# Messages sent when the user has been idle; {name} is the user's preferred name
+ENGAGEMENT_TEMPLATES = (
+    "Hey there! Still with me? I'd love to chat more about what's on your mind.",
+    "Hi {name}! Anything else you'd like to talk about today?",
+    "I'm here if you want to continue our conversation. What else is on your mind?",
+    "Just checking in! Is there anything else you'd like to discuss, {name}?",
+    "Taking a break? I'm here whenever you're ready to chat again!"
+)
+
+# Onboarding form choices
+COMMUNICATION_STYLES = ["Direct and to-the-point", "Detailed and expressive", "Casual and conversational", "Thoughtful and analytical"]
+INTEREST_OPTIONS = ["Technology", "Sports", "Cooking", "Travel", "Music", "Movies", "Reading", "Fitness",
+                    "Art", "Photography", "Gaming", "Fashion", "Science", "Education", "Business"]
+EMOTIONAL_STATES = ["Very stressed", "Somewhat stressed", "Neutral", "Somewhat positive", "Very positive"]
+
 def collect_user_profile():
     """Collect user profile information through a series of questions."""
     st.subheader("Let's get to know you better")
@@ -308,13 +573,11 @@ def collect_user_profile():
     
     communication_style = st.radio(
         "How would you describe your communication style?",
-        ["Direct and to-the-point", "Detailed and expressive", "Casual and conversational", "Thoughtful and analytical"]
+        COMMUNICATION_STYLES
     )
-    interest_options = ["Technology", "Sports", "Cooking", "Travel", "Music", "Movies", "Reading", "Fitness", 
-                       "Art", "Photography", "Gaming", "Fashion", "Science", "Education", "Business"]
     selected_interests = st.multiselect(
         "What are your main interests? (Select at least 2)",
-        interest_options,
+        INTEREST_OPTIONS,
         help="Examples: Technology, Cooking, Travel, Photography, etc."
     )
     custom_interest = st.text_input("Any other interests not listed above? (Comma-separated)", 
@@ -332,7 +595,7 @@ def collect_user_profile():
                                     placeholder="Example: Morning coffee, evening walks, reading before bed, watching sunsets")
     emotional_state = st.select_slider(
         "How would you describe your current emotional state?",
-        options=["Very stressed", "Somewhat stressed", "Neutral", "Somewhat positive", "Very positive"]
+        options=EMOTIONAL_STATES
     )
     
     user_profile = {
@@ -348,14 +611,382 @@ def collect_user_profile():
     }
     return user_profile
 
+def set_profile(user_profile):
+    """Set the user profile and its version token, a stable hash of the profile contents."""
+    st.session_state.user_profile = user_profile
+    st.session_state.user_profile_version = None
+    if user_profile is not None:
+        profile_json = json.dumps(user_profile, sort_keys=True).encode()
+        st.session_state.user_profile_version = hashlib.blake2b(profile_json, digest_size=8).hexdigest()
+
+def get_history_log_path(conversation_id):
+    """Get the path of the on-disk log holding every message of a conversation."""
+    return f"conversation_data/history_{conversation_id}.jsonl"
+
+def new_response_id():
+    """Take a response ID from the pre-generated pool, generating one if it is empty."""
+    try:
+        return uuid_pool.get_nowait()
+    except queue.Empty:
+        return uuid.uuid4().hex
+
+def format_context_line(message):
+    """Format a history message as a line of conversation context."""
+    role = "User" if message["role"] == "user" else "BestieAI"
+    return f"{role}: {message['content']}"
+
+def add_to_history(message, variants=None):
+    """Append a message to the in-memory history and the conversation log.
+
+    A/B variants are written to the log but kept out of the in-memory history; they are
+    held in pending_ab until the user picks one.
+    """
+    history = st.session_state.conversation_history
+    history.append(message)
+    st.session_state.context_cache = None
+    # Queue the message leaving the context window for the rolling summary
+    if len(history) > CONTEXT_WINDOW:
+        st.session_state.summary_backlog.append(format_context_line(history[-CONTEXT_WINDOW - 1]))
+        if len(st.session_state.summary_backlog) >= SUMMARY_INTERVAL and st.session_state.summary_future is None:
+            st.session_state.summary_future = run_in_background(
+                summarize_conversation, st.session_state.rolling_summary, st.session_state.summary_backlog
+            )
+            st.session_state.summary_batch = st.session_state.summary_backlog
+            st.session_state.summary_backlog = []
+    if variants:
+        st.session_state.pending_ab = {"response_id": message["response_id"], **variants}
+        message = {**message, **variants}
+    try:
+        with open(get_history_log_path(st.session_state.conversation_id), "a") as f:
+            f.write(json.dumps(message) + "\n")
+    except OSError as e:
+        st.error(f"Failed to write conversation log: {str(e)}")
+
+def select_response(technique):
+    """Record the user's pick for the pending A/B pair and collapse it into its history entry."""
+    pending_ab = st.session_state.pending_ab
+    response_id = pending_ab["response_id"]
+    content = pending_ab["responses"][technique]
+    message = next(m for m in reversed(st.session_state.conversation_history) if m.get("response_id") == response_id)
+    pending_ab["technique"] = technique
+    st.session_state.preferred_technique[response_id] = technique
+    st.session_state.technique_counts[technique] += 1
+    update_stable_preference()
+    message["content"] = content
+    message["technique"] = technique
+    record_reply_length(content, pending_ab["finish_reasons"][technique])
+    st.session_state.context_cache = None
+    st.session_state.last_interaction_time = time.monotonic()
+    # Reset current_message_processed to allow new input
+    st.session_state.current_message_processed = False
+
+def load_full_history(conversation_id, preferred_technique):
+    """Rebuild the full conversation history from its log, applying selected A/B responses.
+
+    Falls back to the recent messages held in memory if the log is missing. Message
+    timestamps are stored as epoch nanoseconds and converted to ISO format here.
+    """
+    try:
+        with open(get_history_log_path(conversation_id)) as f:
+            history = [json.loads(line) for line in f]
+    except FileNotFoundError:
+        st.warning("Conversation log not found; only the recent messages kept in memory are available.")
+        history = [dict(message) for message in st.session_state.conversation_history]
+    for message in history:
+        message["timestamp"] = datetime.fromtimestamp(message["timestamp"] / 1e9).isoformat()
+        response_id = message.get("response_id")
+        if response_id in preferred_technique and "responses" in message:
+            message["technique"] = preferred_technique[response_id]
+            message["content"] = message["responses"][message["technique"]]
+    return history
+
+def record_reply_length(content, finish_reason=None):
+    """Record the approximate token length of a response the user picked.
+
+    A response cut off by the token cap is recorded as MAX_RESPONSE_TOKENS, so a cap that
+    has become too low can climb back.
+    """
+    if finish_reason == "length":
+        st.session_state.reply_tokens.append(MAX_RESPONSE_TOKENS)
+    else:
+        st.session_state.reply_tokens.append(len(content.split()) * 1.3)
+
+def get_max_tokens():
+    """Get a completion token cap from the 95th percentile of accepted response lengths.
+
+    The cap only applies once MIN_REPLY_SAMPLES responses have been accepted.
+    """
+    reply_tokens = sorted(st.session_state.reply_tokens)
+    if len(reply_tokens) < MIN_REPLY_SAMPLES:
+        return MAX_RESPONSE_TOKENS
+    p95 = reply_tokens[min(len(reply_tokens) - 1, int(len(reply_tokens) * 0.95))]
+    return int(min(MAX_RESPONSE_TOKENS, max(MIN_RESPONSE_TOKENS, p95 * 1.2)))
+
+def update_stable_preference():
+    """Settle on a technique once it leads the other by STABLE_PREFERENCE_MARGIN votes."""
+    counts = st.session_state.technique_counts
+    leader = max(counts, key=counts.get)
+    lead = counts[leader] - min(counts.values())
+    st.session_state.stable_preference = leader if lead >= STABLE_PREFERENCE_MARGIN else None
+
+def choose_technique():
+    """Choose the technique for a single-response turn.
+
+    Uses the stable preference if there is one, otherwise Thompson sampling over the A/B votes.
+    """
+    if st.session_state.stable_preference:
+        return st.session_state.stable_preference
+    counts = st.session_state.technique_counts
+    total = sum(counts.values())
+    return max(counts, key=lambda technique: random.betavariate(counts[technique] + 1, total - counts[technique] + 1))
+
 def get_conversation_context():
-    """Get the last few exchanges for context."""
+    """Get the rolling summary plus the exchanges before the newest message, cached until either changes.
+
+    The newest message is left out so the prompt can present it separately as the one to answer.
+    """
+    summary_future = st.session_state.summary_future
+    if summary_future is not None and summary_future.done():
+        summary = summary_future.result()
+        if summary:
+            st.session_state.rolling_summary = summary
+        else:
+            # Summarizing failed; put the batch back so it is retried with the next one
+            st.session_state.summary_backlog = st.session_state.summary_batch + st.session_state.summary_backlog
+        st.session_state.summary_batch = []
+        st.session_state.summary_future = None
+        st.session_state.context_cache = None
+    if st.session_state.context_cache is not None:
+        return st.session_state.context_cache
     context = ""
-    for message in st.session_state.conversation_history[-CONTEXT_WINDOW:]:
-        role = "User" if message["role"] == "user" else "BestieAI"
-        content = message["content"]
-        context += f"{role}: {content}\n"
-    return context.strip()
+    if st.session_state.rolling_summary:
+        context += f"Summary of earlier conversation: {st.session_state.rolling_summary}\n"
+    for message in list(st.session_state.conversation_history)[-CONTEXT_WINDOW:-1]:
+        context += format_context_line(message) + "\n"
+    st.session_state.context_cache = context.strip()
+    return st.session_state.context_cache
+
+def format_style_stats(technique_counts):
+    """Format the sidebar's response style percentages, one line per technique."""
+    total_responses = sum(technique_counts.values())
+    if total_responses == 0:
+        return []
+    return [
+        f"- {technique.replace('_', ' ').title()}: {count / total_responses * 100:.1f}%"
+        for technique, count in technique_counts.items()
+    ]
+
+def render_pending_ab():
+    """Show the pending A/B options and record the user's pick.
+
+    Drawn inside the chat fragment, so a pick reruns only the chat; the pick is recorded by
+    the button callback before that rerun.
+    """
+    pending_ab = st.session_state.pending_ab
+    if pending_ab is None:
+        return
+    response_id = pending_ab["response_id"]
+    option_a_tech = pending_ab["option_a_tech"]
+    option_b_tech = pending_ab["option_b_tech"]
+    st.markdown("**BestieAI:** (Please select your preferred response style)")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("**Option A:**")
+        st.markdown(f"{pending_ab['responses'][option_a_tech]}")
+        st.button("👍 Prefer A", key=f"prefer_a_{response_id}", on_click=select_response, args=(option_a_tech,))
+    with col2:
+        st.markdown("**Option B:**")
+        st.markdown(f"{pending_ab['responses'][option_b_tech]}")
+        st.button("👍 Prefer B", key=f"prefer_b_{response_id}", on_click=select_response, args=(option_b_tech,))
+
+def respond_to_message(user_input):
+    """Generate and stream the reply to a new message, then store it in the history.
+
+    Streams into a temporary slot that is replaced by the stored reply, or by the pending A/B
+    pair which render_pending_ab draws next.
+    """
+    stream_slot = st.empty()
+    conversation_context = get_conversation_context()
+    sample_rate = PROBE_RATE if st.session_state.stable_preference else AB_SAMPLE_RATE
+    if random.random() >= sample_rate:
+        # Turn not sampled for the A/B comparison: only generate one technique
+        technique = choose_technique()
+        prompt = PROMPT_GENERATORS[technique](
+            st.session_state.user_profile, st.session_state.user_profile_version, conversation_context, user_input
+        )
+        (response,), (finish_reason,) = stream_completions([prompt], [stream_slot], max_tokens=get_max_tokens())
+        # A single reply cut off by the cap means the cap is too low
+        if finish_reason == "length":
+            record_reply_length(response, finish_reason)
+        add_to_history({
+            "role": "assistant",
+            "content": response,
+            "technique": technique,
+            "timestamp": time.time_ns()
+        })
+    else:
+        response_id = new_response_id()
+        prompts = {
+            technique: generate_prompt(
+                st.session_state.user_profile, st.session_state.user_profile_version, conversation_context, user_input
+            )
+            for technique, generate_prompt in PROMPT_GENERATORS.items()
+        }
+        # Randomly assign techniques to options
+        option_a_tech, option_b_tech = OPTION_ORDERS[random.getrandbits(1)]
+        with stream_slot.container():
+            col1, col2 = st.columns(2)
+            with col1:
+                st.markdown("**Option A:**")
+                option_a_placeholder = st.empty()
+            with col2:
+                st.markdown("**Option B:**")
+                option_b_placeholder = st.empty()
+        (option_a, option_b), (finish_a, finish_b) = stream_completions(
+            [prompts[option_a_tech], prompts[option_b_tech]],
+            [option_a_placeholder, option_b_placeholder],
+            max_tokens=get_max_tokens()
+        )
+        if option_a.strip().lower() == option_b.strip().lower():
+            # Both techniques gave the same answer, so there is nothing to choose between
+            add_to_history({
+                "role": "assistant",
+                "content": option_a,
+                "timestamp": time.time_ns()
+            })
+        else:
+            add_to_history({
+                "role": "assistant",
+                "content": "",
+                "response_id": response_id,
+                "timestamp": time.time_ns()
+            }, variants={
+                "responses": {
+                    option_a_tech: option_a,
+                    option_b_tech: option_b
+                },
+                "finish_reasons": {
+                    option_a_tech: finish_a,
+                    option_b_tech: finish_b
+                },
+                "option_a_tech": option_a_tech,
+                "option_b_tech": option_b_tech
+            })
+            st.session_state.current_message_processed = True
+    stream_slot.empty()
+    last_message = st.session_state.conversation_history[-1]
+    if "response_id" not in last_message:
+        st.markdown(f"**BestieAI:** {last_message['content']}")
+
+def submit_message():
+    """Queue the typed message for the chat and clear the input box."""
+    st.session_state.submitted_input = st.session_state.chat_input
+    st.session_state.chat_input = ""
+
+@st.fragment
+def render_chat():
+    """Render the conversation and handle new messages.
+
+    Runs as a fragment so sending a message reruns only the chat, not the whole page. A new
+    message is added before the history is drawn and its reply streams in below it, so a
+    turn completes within a single run.
+    """
+    # A picked pair is shown by the history loop from here on
+    if st.session_state.pending_ab is not None and "technique" in st.session_state.pending_ab:
+        st.session_state.pending_ab = None
+        # The sidebar stats are outside this fragment; rerun the whole app only if they changed
+        if format_style_stats(st.session_state.technique_counts) != st.session_state.get("displayed_style_stats"):
+            st.rerun()
+    # A message sent while an A/B pick is pending waits in the queue until the pick is made
+    user_input = None
+    if not st.session_state.current_message_processed:
+        user_input = st.session_state.pop("submitted_input", None)
+    if user_input:
+        add_to_history({
+            "role": "user",
+            "content": user_input,
+            "timestamp": time.time_ns()
+        })
+        st.session_state.last_interaction_time = time.monotonic()
+    pending_response_id = st.session_state.pending_ab["response_id"] if st.session_state.pending_ab else None
+    st.subheader("Conversation")
+    chat_container = st.container()
+    with chat_container:
+        messages = list(st.session_state.conversation_history)
+        if len(messages) > DISPLAY_WINDOW:
+            messages = messages[-DISPLAY_WINDOW:]
+            if st.toggle("Show older messages"):
+                full_history = load_full_history(st.session_state.conversation_id, st.session_state.preferred_technique)
+                for message in full_history[:-DISPLAY_WINDOW]:
+                    if message["role"] == "user":
+                        st.markdown(f"**You:** {message['content']}")
+                    else:
+                        st.markdown(f"**BestieAI:** {message['content'] or '(No response selected)'}")
+                st.markdown("---")
+        for message in messages:
+            role = message["role"]
+            content = message["content"]
+            response_id = message.get("response_id")
+            if role == "user":
+                st.markdown(f"**You:** {content}")
+            elif role == "assistant" and (pending_response_id is None or response_id != pending_response_id):
+                st.markdown(f"**BestieAI:** {content}")
+        if user_input:
+            respond_to_message(user_input)
+        render_pending_ab()
+        queued_input = st.session_state.get("submitted_input")
+        if queued_input:
+            st.markdown(f"**You:** {queued_input}")
+            st.caption("This message will be sent after you pick a response.")
+    st.markdown("---")
+    # Only one message can wait behind a pending pick, so input is closed until the pick is made
+    awaiting_pick = st.session_state.pending_ab is not None
+    st.text_input(
+        "Type your message:",
+        key="chat_input",
+        on_change=submit_message,
+        disabled=awaiting_pick,
+        placeholder="Pick a response above to continue" if awaiting_pick else ""
+    )
+
+@st.fragment(run_every=IDLE_CHECK_INTERVAL)
+def check_idle():
+    """Post an engagement message once the user has been idle for a while.
+
+    Runs as a timed fragment so idle users are noticed without waiting for a page rerun.
+    At most one message is posted per idle period, and none while an A/B pick is pending.
+    """
+    if st.session_state.pending_ab is not None:
+        return
+    current_time = time.monotonic()
+    if current_time - st.session_state.last_interaction_time > 60:
+        if "last_engagement_time" not in st.session_state or st.session_state.last_engagement_time < st.session_state.last_interaction_time:
+            engagement_message = random.choice(ENGAGEMENT_TEMPLATES).format(
+                name=st.session_state.user_profile['preferred_name']
+            )
+            add_to_history({
+                "role": "assistant",
+                "content": engagement_message,
+                "timestamp": time.time_ns()
+            })
+            st.session_state.last_engagement_time = current_time
+            st.rerun()
+
+@st.fragment(run_every=EMAIL_CHECK_INTERVAL)
+def report_email_result():
+    """Report the outcome of a background email send once it has finished.
+
+    Runs as a timed fragment so the result shows without waiting for a page rerun.
+    """
+    email_future = st.session_state.email_future
+    if email_future is None or not email_future.done():
+        return
+    email_sent, email_error = email_future.result()
+    if email_sent:
+        st.toast("Conversation data has been sent to the administrator")
+    else:
+        st.toast(f"{email_error} Data has been saved locally.", icon="⚠️")
+    st.session_state.email_future = None
 
 def main():
     st.set_page_config(page_title="BestieAI - Your AI Companion", layout="wide")
@@ -403,23 +1034,45 @@ def main():
             """)
     
     if "user_profile" not in st.session_state:
-        st.session_state.user_profile = None
+        set_profile(None)
     if "conversation_history" not in st.session_state:
-        st.session_state.conversation_history = []
+        st.session_state.conversation_history = deque(maxlen=MAX_HISTORY)
     if "conversation_id" not in st.session_state:
         st.session_state.conversation_id = str(uuid.uuid4())
     if "user_id" not in st.session_state:
         st.session_state.user_id = str(uuid.uuid4())
     if "preferred_technique" not in st.session_state:
         st.session_state.preferred_technique = {}
+    if "pending_ab" not in st.session_state:
+        st.session_state.pending_ab = None
+    if "technique_counts" not in st.session_state:
+        st.session_state.technique_counts = {"conditional": 0, "dynamic_context": 0}
+    if "reply_tokens" not in st.session_state:
+        st.session_state.reply_tokens = []
+    if "stable_preference" not in st.session_state:
+        st.session_state.stable_preference = None
     if "onboarding_complete" not in st.session_state:
         st.session_state.onboarding_complete = False
     if "current_message_processed" not in st.session_state:
         st.session_state.current_message_processed = False
     if "last_interaction_time" not in st.session_state:
-        st.session_state.last_interaction_time = time.time()
-    if "input_key" not in st.session_state:
-        st.session_state.input_key = 0
+        st.session_state.last_interaction_time = time.monotonic()
+    if "context_cache" not in st.session_state:
+        st.session_state.context_cache = None
+    if "rolling_summary" not in st.session_state:
+        st.session_state.rolling_summary = ""
+    if "summary_backlog" not in st.session_state:
+        st.session_state.summary_backlog = []
+    if "summary_batch" not in st.session_state:
+        st.session_state.summary_batch = []
+    if "summary_future" not in st.session_state:
+        st.session_state.summary_future = None
+    if "email_future" not in st.session_state:
+        st.session_state.email_future = None
+
+    # Poll a background email send until its outcome has been reported
+    if st.session_state.email_future is not None:
+        report_email_result()
 
     st.title("BestieAI - Your Personal AI Companion")
 
@@ -437,17 +1090,17 @@ def main():
                 if not user_profile["name"]:
                     st.error("Please enter your name to continue.")
                 else:
-                    st.session_state.user_profile = user_profile
+                    set_profile(user_profile)
                     st.session_state.onboarding_complete = True
                     st.rerun()
     if st.session_state.onboarding_complete:
         # Display welcome message on first chat
         if not st.session_state.conversation_history:
             welcome_message = f"Hi {st.session_state.user_profile['preferred_name']}! I'm BestieAI, your friendly companion. What's on your mind today?"
-            st.session_state.conversation_history.append({
+            add_to_history({
                 "role": "assistant",
                 "content": welcome_message,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": time.time_ns()
             })
         with st.sidebar:
             st.subheader(f"Hi, {st.session_state.user_profile['preferred_name']}!")
@@ -464,38 +1117,31 @@ def main():
             
             # Technique preference analysis
             st.subheader("Response Style Analysis")
-            technique_counts = {"conditional": 0, "dynamic_context": 0}
-            for technique in st.session_state.preferred_technique.values():
-                if technique in technique_counts:
-                    technique_counts[technique] += 1
-            total_responses = sum(technique_counts.values())
-            if total_responses > 0:
+            technique_counts = st.session_state.technique_counts
+            style_stats = format_style_stats(technique_counts)
+            st.session_state.displayed_style_stats = style_stats
+            if style_stats:
                 st.write("Response style preferences:")
-                for technique, count in technique_counts.items():
-                    percentage = (count / total_responses) * 100
-                    st.write(f"- {technique.replace('_', ' ').title()}: {percentage:.1f}%")
+                for line in style_stats:
+                    st.write(line)
             st.subheader("Feedback")
             feedback = st.text_area("Please share what you liked, what could be improved, or what's missing:", key="feedback")
             if st.button("Save & End Conversation"):
-                technique_counts = {"conditional": 0, "dynamic_context": 0}
-                for technique in st.session_state.preferred_technique.values():
-                    if technique in technique_counts:
-                        technique_counts[technique] += 1
                 preferred_technique = max(technique_counts, key=technique_counts.get) if technique_counts else None
                 # Save conversation and explicitly request email sending
                 result = save_conversation(
                     st.session_state.conversation_id,
                     st.session_state.user_id,
-                    st.session_state.conversation_history,
+                    load_full_history(st.session_state.conversation_id, st.session_state.preferred_technique),
                     preferred_technique,
                     feedback,
                     send_email_report=True  # Explicitly request email sending
                 )
                 
                 if isinstance(result, tuple):
-                    filename, email_sent = result
+                    filename, st.session_state.email_future = result
                 else:
-                    filename, email_sent = result, False
+                    filename = result
                 
                 if filename:
                     st.success(f"Conversation saved to {filename}")
@@ -514,127 +1160,29 @@ def main():
                     """
                     
                     st.info(summary_text)
-                    
-                    # Show email status
-                    if os.getenv("ADMIN_EMAIL"):
-                        if email_sent:
-                            st.success("Conversation data has been sent to the administrator")
-                        else:
-                            st.warning("Failed to send email to administrator. Data has been saved locally.")
                 
                 # Reset session state
-                st.session_state.user_profile = None
-                st.session_state.conversation_history = []
+                set_profile(None)
+                st.session_state.conversation_history = deque(maxlen=MAX_HISTORY)
                 st.session_state.conversation_id = str(uuid.uuid4())
                 st.session_state.user_id = str(uuid.uuid4())
                 st.session_state.preferred_technique = {}
+                st.session_state.pending_ab = None
+                st.session_state.technique_counts = {"conditional": 0, "dynamic_context": 0}
+                st.session_state.stable_preference = None
+                st.session_state.reply_tokens = []
                 st.session_state.onboarding_complete = False
                 st.session_state.current_message_processed = False
-                st.session_state.last_interaction_time = time.time()
-                st.session_state.input_key = 0
-                st.rerun()
-        st.subheader("Conversation")
-        chat_container = st.container()
-        with chat_container:
-            for message in st.session_state.conversation_history:
-                role = message["role"]
-                content = message["content"]
-                timestamp = message.get("timestamp", datetime.now().isoformat())
-                response_id = message.get("response_id", str(uuid.uuid4()))
-                if role == "user":
-                    st.markdown(f"**You:** {content}")
-                elif role == "assistant":
-                    if "responses" in message:
-                        responses = message["responses"]
-                        option_a_tech = message.get("option_a_tech")
-                        option_b_tech = message.get("option_b_tech")
-                        option_a = responses[option_a_tech]
-                        option_b = responses[option_b_tech]
-                        
-                        # If user has already selected a preferred response
-                        if response_id in st.session_state.preferred_technique:
-                            preferred_technique = st.session_state.preferred_technique[response_id]
-                            preferred_content = responses[preferred_technique]
-                            st.markdown(f"**BestieAI:** {preferred_content}")
-                        else:
-                            st.markdown("**BestieAI:** (Please select your preferred response style)")
-                            col1, col2 = st.columns(2)
-                            with col1:
-                                st.markdown("**Option A:**")
-                                st.markdown(f"{option_a}")
-                                if st.button("👍 Prefer A", key=f"prefer_a_{response_id}"):
-                                    st.session_state.preferred_technique[response_id] = option_a_tech
-                                    message["content"] = option_a
-                                    # Reset current_message_processed to allow new input
-                                    st.session_state.current_message_processed = False
-                                    st.rerun()
-                            with col2:
-                                st.markdown("**Option B:**")
-                                st.markdown(f"{option_b}")
-                                if st.button("👍 Prefer B", key=f"prefer_b_{response_id}"):
-                                    st.session_state.preferred_technique[response_id] = option_b_tech
-                                    message["content"] = option_b
-                                    # Reset current_message_processed to allow new input
-                                    st.session_state.current_message_processed = False
-                                    st.rerun()
-                    else:
-                        st.markdown(f"**BestieAI:** {content}")
-        st.markdown("---")
-        user_input = st.text_input("Type your message:", key=f"input_{st.session_state.input_key}")
-        if user_input and not st.session_state.current_message_processed:
-            st.session_state.conversation_history.append({
-                "role": "user",
-                "content": user_input,
-                "timestamp": datetime.now().isoformat()
-            })
-            st.session_state.last_interaction_time = time.time()
-            conversation_context = get_conversation_context()
-            response_id = str(uuid.uuid4())
-            with st.spinner("Thinking..."):
-                conditional_prompt = generate_conditional_response_prompt(st.session_state.user_profile, conversation_context)
-                conditional_response = get_completion(conditional_prompt, user_input)
-                dynamic_context_prompt = generate_dynamic_context_prompt(st.session_state.user_profile, conversation_context)
-                dynamic_context_response = get_completion(dynamic_context_prompt, user_input)
-                # Shuffle techniques for options
-                techniques = ["conditional", "dynamic_context"]
-                random.shuffle(techniques)
-                option_a_tech, option_b_tech = techniques
-                option_a = conditional_response if option_a_tech == "conditional" else dynamic_context_response
-                option_b = conditional_response if option_b_tech == "conditional" else dynamic_context_response
-            st.session_state.conversation_history.append({
-                "role": "assistant",
-                "content": "",
-                "response_id": response_id,
-                "responses": {
-                    "conditional": conditional_response,
-                    "dynamic_context": dynamic_context_response
-                },
-                "option_a_tech": option_a_tech,
-                "option_b_tech": option_b_tech,
-                "timestamp": datetime.now().isoformat()
-            })
-            st.session_state.current_message_processed = True
-            st.session_state.input_key += 1
-            st.rerun()
-        current_time = time.time()
-        if current_time - st.session_state.last_interaction_time > 60:
-            if "last_engagement_time" not in st.session_state or current_time - st.session_state.last_engagement_time > 100:
-                engagement_messages = [
-                    "Hey there! Still with me? I'd love to chat more about what's on your mind.",
-                    f"Hi {st.session_state.user_profile['preferred_name']}! Anything else you'd like to talk about today?",
-                    "I'm here if you want to continue our conversation. What else is on your mind?",
-                    f"Just checking in! Is there anything else you'd like to discuss, {st.session_state.user_profile['preferred_name']}?",
-                    f"Taking a break? I'm here whenever you're ready to chat again!"
-                ]
-                engagement_message = random.choice(engagement_messages)
-                st.session_state.conversation_history.append({
-                    "role": "assistant",
-                    "content": engagement_message,
-                    "timestamp": datetime.now().isoformat()
-                })
-                st.session_state.last_engagement_time = current_time
-                st.session_state.last_interaction_time = current_time
+                st.session_state.last_interaction_time = time.monotonic()
+                st.session_state.pop("submitted_input", None)
+                st.session_state.context_cache = None
+                st.session_state.rolling_summary = ""
+                st.session_state.summary_backlog = []
+                st.session_state.summary_batch = []
+                st.session_state.summary_future = None
                 st.rerun()
+        render_chat()
+        check_idle()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file